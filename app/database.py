@@ -1,7 +1,8 @@
-from sqlalchemy import Column, Integer, String, create_engine
+from sqlalchemy import Column, Index, Integer, LargeBinary, String, create_engine, func
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import os
+import secrets
 from dotenv import load_dotenv
 
 # Load environment variables from .env file (for local development)
@@ -14,8 +15,15 @@ class UserDB(Base):
     __tablename__ = "users"
     
     id = Column(Integer, primary_key=True, index=True)
-    email = Column(String, unique=True, index=True, nullable=False)
-    password = Column(String(255), nullable=False)  # Stores bcrypt hash
+    email = Column(String, nullable=False)  # Uniqueness enforced by ix_users_email_lower
+    password = Column(LargeBinary(60), nullable=False)  # Raw 60-byte bcrypt hash
+    # Random per-user salt for the in-memory login verification cache
+    verify_salt = Column(LargeBinary(16), nullable=True, default=lambda: secrets.token_bytes(16))
+
+    # Case-insensitive unique index; query with func.lower(UserDB.email) to use it
+    __table_args__ = (
+        Index("ix_users_email_lower", func.lower(email), unique=True),
+    )
 
 # Get database URL from environment variable
 # Render automatically provides DATABASE_URL for PostgreSQL databases
@@ -29,22 +37,29 @@ DATABASE_URL = os.getenv(
 if DATABASE_URL.startswith("postgres://"):
     DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
 
+# Pool sizing is per worker process: total connections can reach
+# workers * (SQLA_POOL_SIZE + SQLA_MAX_OVERFLOW), so keep that below the
+# database's max_connections (100 by default on PostgreSQL)
+POOL_SIZE = int(os.getenv("SQLA_POOL_SIZE", "5"))
+MAX_OVERFLOW = int(os.getenv("SQLA_MAX_OVERFLOW", "10"))
+
 # Create engine with connection pooling for production
 engine = create_engine(
     DATABASE_URL,
-    pool_pre_ping=True,  # Verify connections before using them
-    pool_size=10,        # Number of permanent connections
-    max_overflow=20,     # Additional connections when needed
-    echo=False           # Set to True for SQL query logging in development
+    pool_pre_ping=True,         # Verify connections before using them
+    pool_size=POOL_SIZE,        # Number of permanent connections
+    max_overflow=MAX_OVERFLOW,  # Additional connections when needed
+    pool_recycle=3600,          # Replace connections older than an hour
+    pool_timeout=10,            # Fail fast when the pool is exhausted
+    echo=False                  # Set to True for SQL query logging in development
 )
 
 # Create session factory
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# expire_on_commit=False: sessions are per-request, so there is no need to
+# reload attributes from the database after each commit
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
 
 # Create all tables
 def init_db():
-    """Initialize database tables"""
+    """Initialize database tables (called from the app lifespan, not on import)"""
     Base.metadata.create_all(bind=engine)
-
-# Initialize tables when module is imported
-init_db()
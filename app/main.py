@@ -1,29 +1,70 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 import os
-from app.routes import router
+from slowapi import _rate_limit_exceeded_handler
+from slowapi.errors import RateLimitExceeded
+from app.database import init_db
+from app.password_utils import shutdown_bcrypt_pool
+from app.routes import limiter, router
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create tables on startup instead of at import time; stop the bcrypt pool on exit"""
+    # Set SKIP_INIT_DB=1 when schema is managed by a separate migration job
+    if os.getenv("SKIP_INIT_DB") != "1":
+        init_db()
+    yield
+    shutdown_bcrypt_pool()
+
 
 app = FastAPI(
     title="User Management System",
     description="A secure user CRUD application with web UI",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse  # Faster JSON serialization than stdlib json
 )
 
+# Rate limiting (limits are declared on the routes themselves)
+app.state.limiter = limiter
+app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+
 # CORS Configuration for production
-# Update origins list with your actual frontend domain when deployed
+# Set ALLOWED_ORIGINS to a comma-separated list of frontend domains.
+# The bundled web UI is same-origin, so no origins are allowed by default.
+ALLOWED_ORIGINS = [
+    origin.strip()
+    for origin in os.getenv("ALLOWED_ORIGINS", "").split(",")
+    if origin.strip()
+]
+
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # In production, replace with your domain
+    allow_origins=ALLOWED_ORIGINS,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST", "PUT", "DELETE"],
+    allow_headers=["authorization", "content-type"],
+    max_age=86400,  # Let browsers cache preflight responses for a day
 )
 
+class CachedStaticFiles(StaticFiles):
+    """StaticFiles that lets browsers and CDN edges cache assets for a week"""
+
+    def file_response(self, *args, **kwargs):
+        response = super().file_response(*args, **kwargs)
+        response.headers.setdefault("Cache-Control", "public, max-age=604800")
+        return response
+
+
 # Mount static files (CSS, JS, images)
-# Make sure static folder exists
-if os.path.exists("static"):
-    app.mount("/static", StaticFiles(directory="static"), name="static")
+# Make sure static folder exists. Set SERVE_STATIC=0 when a reverse proxy
+# or CDN serves /static directly.
+if os.getenv("SERVE_STATIC", "1") != "0" and os.path.exists("static"):
+    app.mount("/static", CachedStaticFiles(directory="static"), name="static")
 
 # Include API and UI routes
 app.include_router(router)
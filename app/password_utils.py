@@ -2,10 +2,34 @@
 Fixed password hashing utilities for FastAPI
 Works with bcrypt 4.x versions
 """
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, List, Optional, TypeVar
+
 import bcrypt
 
+T = TypeVar("T")
+
+# bcrypt cost factor (work = 2^rounds). Read once at import time.
+# Production deployments can tune this via BCRYPT_ROUNDS (10-13 is typical).
+# Checked here so a bad setting fails at startup, not on the first hash.
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "10"))
+if not 4 <= BCRYPT_ROUNDS <= 31:
+    raise ValueError(f"BCRYPT_ROUNDS must be between 4 and 31, got {BCRYPT_ROUNDS}")
+
+# Process pool for CPU-bound bcrypt work. Created lazily on first use so
+# importing this module (e.g. in each uvicorn/gunicorn worker, or in the
+# pool's own child processes) does not spawn processes. Children are started
+# with forkserver/spawn because forking a multi-threaded worker is unsafe.
+_bcrypt_pool: Optional[ProcessPoolExecutor] = None
+# Endpoints run in FastAPI's threadpool, so creation must not race
+_bcrypt_pool_lock = threading.Lock()
+
 
-def hash_password(password: str) -> str:
+def hash_password(password: str) -> bytes:
     """
     Hash a password using bcrypt directly (not passlib)
     
@@ -13,46 +37,125 @@ def hash_password(password: str) -> str:
         password: Plain text password to hash
         
     Returns:
-        Hashed password as string
+        60-byte bcrypt hash, stored as-is in the password column
         
     Note:
         bcrypt has a 72-byte limit. For longer passwords,
-        we truncate to 72 bytes (which is ~72 characters for ASCII)
+        we truncate to 72 bytes (which is ~72 characters for ASCII).
+        The cost factor comes from BCRYPT_ROUNDS (default 10).
     """
     # Truncate password if needed (bcrypt has 72 byte limit)
     password_bytes = password.encode('utf-8')[:72]
     
     # Generate salt and hash
-    salt = bcrypt.gensalt()
-    hashed = bcrypt.hashpw(password_bytes, salt)
-    
-    # Return as string
-    return hashed.decode('utf-8')
+    salt = bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
+    return bcrypt.hashpw(password_bytes, salt)
 
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
+def verify_password(plain_password: str, hashed_password: bytes) -> bool:
     """
     Verify a password against a hash
     
     Args:
         plain_password: Plain text password to verify
-        hashed_password: Hashed password to compare against
+        hashed_password: bcrypt hash bytes to compare against
         
     Returns:
         True if password matches, False otherwise
     """
     # Truncate password if needed (same as when hashing)
     password_bytes = plain_password.encode('utf-8')[:72]
-    hashed_bytes = hashed_password.encode('utf-8')
     
     try:
-        return bcrypt.checkpw(password_bytes, hashed_bytes)
+        return bcrypt.checkpw(password_bytes, hashed_password)
     except Exception as e:
         # Handle any bcrypt errors gracefully
         print(f"Password verification error: {e}")
         return False
 
 
+def needs_rehash(hashed_password: bytes) -> bool:
+    """
+    Check whether a stored hash uses a cost other than BCRYPT_ROUNDS
+    
+    Hashes look like b"$2b$12$...", with the cost at bytes 4-5. Hashes
+    created before BCRYPT_ROUNDS existed use bcrypt's default of 12.
+    """
+    try:
+        return int(hashed_password[4:6]) != BCRYPT_ROUNDS
+    except ValueError:
+        return False
+
+
+def get_bcrypt_pool() -> ProcessPoolExecutor:
+    """Return the shared bcrypt process pool, creating it on first use"""
+    global _bcrypt_pool
+    if _bcrypt_pool is None:
+        with _bcrypt_pool_lock:
+            if _bcrypt_pool is None:
+                start_method = (
+                    "forkserver"
+                    if "forkserver" in multiprocessing.get_all_start_methods()
+                    else "spawn"
+                )
+                _bcrypt_pool = ProcessPoolExecutor(
+                    max_workers=os.cpu_count(),
+                    mp_context=multiprocessing.get_context(start_method),
+                )
+    return _bcrypt_pool
+
+
+def shutdown_bcrypt_pool() -> None:
+    """Shut down the bcrypt process pool, if one was started (app shutdown)"""
+    global _bcrypt_pool
+    with _bcrypt_pool_lock:
+        pool, _bcrypt_pool = _bcrypt_pool, None
+    if pool is not None:
+        pool.shutdown()
+
+
+def _run_in_bcrypt_pool(work: Callable[[ProcessPoolExecutor], T]) -> T:
+    """
+    Run work(pool) against the bcrypt pool, recovering from a dead child
+    
+    A child killed mid-task (OOM, segfault) marks the whole executor as
+    broken, so every later submit would fail. Replace it and retry once.
+    """
+    global _bcrypt_pool
+    pool = get_bcrypt_pool()
+    try:
+        return work(pool)
+    except BrokenProcessPool:
+        with _bcrypt_pool_lock:
+            # Another thread may already have replaced it
+            if _bcrypt_pool is pool:
+                _bcrypt_pool = None
+        pool.shutdown(wait=False)
+        return work(get_bcrypt_pool())
+
+
+def hash_password_pooled(password: str) -> bytes:
+    """
+    Run hash_password in the bcrypt process pool and wait for the result
+    
+    Call from sync endpoints (which FastAPI runs in its threadpool), never
+    directly on the event loop
+    """
+    return _run_in_bcrypt_pool(lambda pool: pool.submit(hash_password, password).result())
+
+
+def hash_passwords_pooled(passwords: List[str]) -> List[bytes]:
+    """Hash several passwords concurrently across the bcrypt process pool"""
+    return _run_in_bcrypt_pool(lambda pool: list(pool.map(hash_password, passwords)))
+
+
+def verify_password_pooled(plain_password: str, hashed_password: bytes) -> bool:
+    """Run verify_password in the bcrypt process pool and wait for the result"""
+    return _run_in_bcrypt_pool(
+        lambda pool: pool.submit(verify_password, plain_password, hashed_password).result()
+    )
+
+
 # Test the functions if run directly
 if __name__ == "__main__":
     # Test hashing
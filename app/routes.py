@@ -1,42 +1,159 @@
-from fastapi import APIRouter, HTTPException, Depends, Request
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import threading
+from cachetools import TTLCache
+from fastapi import APIRouter, HTTPException, Depends, Path, Query, Request
 from fastapi.responses import HTMLResponse
+from jinja2 import FileSystemBytecodeCache
 from fastapi.templating import Jinja2Templates
-from sqlalchemy.orm import Session
-from pydantic import BaseModel, EmailStr, Field
-from typing import List
+from sqlalchemy import delete, exists, func, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, load_only
+from slowapi import Limiter
+from slowapi.util import get_remote_address
+from pydantic import BaseModel, ConfigDict, EmailStr, Field, field_validator
+from typing import List, Optional
 from .database import SessionLocal, UserDB
-from .password_utils import hash_password, verify_password
+from .password_utils import (
+    hash_password,
+    hash_password_pooled,
+    hash_passwords_pooled,
+    needs_rehash,
+    verify_password_pooled,
+)
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
+
+IS_PRODUCTION = os.getenv("ENVIRONMENT") == "production"
+
+# Per-client-IP rate limits on the bcrypt endpoints, checked before any
+# hashing happens. Point RATE_LIMIT_STORAGE_URI at Redis
+# (redis://host:6379) so limits are shared across workers; the in-memory
+# default counts per worker process and resets on restart. Behind a reverse
+# proxy, set FORWARDED_ALLOW_IPS so uvicorn/gunicorn take the client address
+# from X-Forwarded-For; otherwise every client shares the proxy's bucket.
+RATE_LIMIT_STORAGE_URI = os.getenv("RATE_LIMIT_STORAGE_URI")
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") != "0"
+if IS_PRODUCTION and RATE_LIMIT_ENABLED and not RATE_LIMIT_STORAGE_URI:
+    logger.warning(
+        "RATE_LIMIT_STORAGE_URI is not set; rate limits are kept in memory per "
+        "worker, so each client gets the limit once per worker and counters "
+        "reset on restart. Set it to a Redis URL in production."
+    )
+
+limiter = Limiter(
+    key_func=get_remote_address,
+    storage_uri=RATE_LIMIT_STORAGE_URI or "memory://",
+    enabled=RATE_LIMIT_ENABLED,
+)
 
 # Initialize Jinja2 templates
 templates = Jinja2Templates(directory="templates")
 
+# Cache compiled templates on disk so each worker compiles them only once,
+# and skip per-render mtime checks outside development. The default cache
+# directory is per-user (_jinja2-cache-<uid>), mode 0700 and owner-checked.
+templates.env.bytecode_cache = FileSystemBytecodeCache()
+templates.env.auto_reload = not IS_PRODUCTION
+
+# Rendered HTML for pages that take no per-request context
+_static_pages: dict = {}
+
+def render_static_page(name: str) -> str:
+    """Render a context-free template once (per process in production)"""
+    html = _static_pages.get(name)
+    if html is None:
+        html = templates.get_template(name).render()
+        if IS_PRODUCTION:
+            _static_pages[name] = html
+    return html
+
+# Hash checked against when the login email is unknown, so both paths do the
+# same bcrypt work and response time doesn't reveal which emails exist.
+# Accounts hashed at another cost (e.g. the old default of 12) are rehashed
+# at BCRYPT_ROUNDS on their next login, so their timing converges too.
+_DUMMY_HASH = hash_password("x" * 16)
+
+# email -> sha256(verify_salt + password) for recently verified logins, so
+# repeat logins skip bcrypt. Bounded in size and lifetime. Each worker
+# process has its own copy, so a password change also rotates verify_salt,
+# making stale entries in other workers unable to match. Endpoints run in
+# threadpool threads and TTLCache isn't thread-safe, hence the lock.
+_verify_cache: TTLCache = TTLCache(maxsize=10_000, ttl=300)
+_verify_cache_lock = threading.Lock()
+
+def _verify_cache_key(salt: bytes, password: str) -> bytes:
+    """Digest stored in the verification cache for a salt/password pair"""
+    return hashlib.sha256(salt + password.encode('utf-8')).digest()
+
 # ============================================================================
 # PYDANTIC MODELS - Enhanced with validation
 # ============================================================================
 
+# RFC 5321 maximum email address length
+MAX_EMAIL_LENGTH = 254
+
+# Shared by request bodies: reject unknown fields and oversized strings
+REQUEST_MODEL_CONFIG = ConfigDict(extra="forbid", str_max_length=1000)
+
+def normalize_email(value):
+    """
+    Strip and lowercase an email, rejecting oversized input early
+    
+    Runs before EmailStr validation so giant strings never reach the
+    email parser, and so lookups against the unique index match
+    regardless of the case the client sent
+    """
+    if isinstance(value, str):
+        value = value.strip().lower()
+        if len(value) > MAX_EMAIL_LENGTH:
+            raise ValueError(f"Email must be at most {MAX_EMAIL_LENGTH} characters")
+    return value
+
 class UserSchema(BaseModel):
-    email: EmailStr  # Better email validation
+    email: EmailStr = Field(..., max_length=MAX_EMAIL_LENGTH)  # Better email validation
     password: str = Field(..., min_length=8, max_length=72)  # bcrypt limit
     
-    class Config:
-        json_schema_extra = {
+    model_config = ConfigDict(
+        **REQUEST_MODEL_CONFIG,
+        json_schema_extra={
             "example": {
                 "email": "user@example.com",
                 "password": "securepass123"
             }
         }
+    )
+    
+    @field_validator("email", mode="before")
+    @classmethod
+    def check_email(cls, value):
+        return normalize_email(value)
+
+class BulkUserSchema(BaseModel):
+    # Kept small: every entry costs a full bcrypt hash
+    users: List[UserSchema] = Field(..., min_length=1, max_length=100)
+    
+    model_config = REQUEST_MODEL_CONFIG
 
 class UserResponse(BaseModel):
     id: int
     email: str
     
-    class Config:
-        from_attributes = True  # For SQLAlchemy model compatibility
+    model_config = ConfigDict(from_attributes=True)  # For SQLAlchemy model compatibility
+
+class UserPage(BaseModel):
+    users: List[UserResponse]
+    next_cursor: Optional[int] = None  # Pass as after_id to get the next page
 
 class PasswordUpdate(BaseModel):
     new_password: str = Field(..., min_length=8, max_length=72)
+    
+    model_config = REQUEST_MODEL_CONFIG
 
 class MessageResponse(BaseModel):
     message: str
@@ -53,33 +170,43 @@ def get_db():
     finally:
         db.close()
 
+def get_users_page(db: Session, limit: int, after_id: Optional[int]):
+    """
+    Fetch one page of users ordered by id (keyset pagination)
+    
+    Returns (users, next_cursor); next_cursor is None on the last page
+    """
+    query = db.query(UserDB).options(load_only(UserDB.id, UserDB.email)).order_by(UserDB.id)
+    if after_id is not None:
+        query = query.filter(UserDB.id > after_id)
+    users = query.limit(limit).all()
+    next_cursor = users[-1].id if len(users) == limit else None
+    return users, next_cursor
+
 # ============================================================================
 # WEB UI ROUTES (Jinja2 Templates)
 # ============================================================================
 
 @router.get("/", response_class=HTMLResponse, tags=["Web UI"])
-async def home(request: Request, db: Session = Depends(get_db)):
-    """Main page displaying all users"""
-    users = db.query(UserDB).all()
+async def home(request: Request):
+    """Main landing page"""
     return templates.TemplateResponse(
         "index.html",
-        {"request": request, "users": users}
+        {"request": request}
     )
 
 @router.get("/register-page", response_class=HTMLResponse, tags=["Web UI"])
 async def register_page(request: Request):
     """User registration page"""
-    return templates.TemplateResponse(
-        "register.html",
-        {"request": request}
-    )
+    return HTMLResponse(render_static_page("register.html"))
 
 # ============================================================================
 # API ROUTES (JSON endpoints)
 # ============================================================================
 
 @router.post("/api/user", status_code=201, response_model=MessageResponse, tags=["API"])
-def register(user: UserSchema, db: Session = Depends(get_db)):
+@limiter.limit("3/hour")
+def register(request: Request, user: UserSchema, db: Session = Depends(get_db)):
     """
     Register a new user with hashed password
     
@@ -87,63 +214,130 @@ def register(user: UserSchema, db: Session = Depends(get_db)):
     BUG FIX: Added proper error handling and response models
     COMPATIBILITY FIX: Uses bcrypt directly instead of passlib
     """
-    # Check if user already exists
-    existing_user = db.query(UserDB).filter(UserDB.email == user.email).first()
-    if existing_user:
+    # Check if user already exists (SELECT EXISTS, no row loaded) before
+    # spending bcrypt time on the password
+    already_exists = db.query(exists().where(func.lower(UserDB.email) == user.email)).scalar()
+    if already_exists:
         raise HTTPException(status_code=400, detail="User already exists")
+    # End the read transaction so the pooled connection is released while hashing
+    db.commit()
     
     # Hash the password before storing
-    hashed_pw = hash_password(user.password)
+    hashed_pw = hash_password_pooled(user.password)
     
     # Create new user
     new_user = UserDB(email=user.email, password=hashed_pw)
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)  # Get the created user with ID
+    try:
+        db.commit()
+    except IntegrityError:
+        # Lost a race with a concurrent registration for the same email
+        db.rollback()
+        raise HTTPException(status_code=400, detail="User already exists")
     
     return {"message": "User registered successfully"}
 
-@router.get("/api/users", response_model=List[UserResponse], tags=["API"])
-def get_all_users(db: Session = Depends(get_db)):
+@router.post("/api/users/bulk", status_code=201, response_model=MessageResponse, tags=["API"])
+@limiter.limit("3/hour")
+def register_bulk(request: Request, data: BulkUserSchema, db: Session = Depends(get_db)):
+    """
+    Register many users with one INSERT and one commit
+    
+    Emails that already exist (or repeat within the batch) are skipped
+    rather than failing the whole batch
+    """
+    # Drop in-batch duplicates, keeping the first occurrence
+    unique_users = {}
+    for user in data.users:
+        unique_users.setdefault(user.email, user)
+    
+    # Skip emails that are already registered before spending bcrypt time on them
+    existing = set(db.scalars(
+        select(func.lower(UserDB.email)).where(func.lower(UserDB.email).in_(unique_users))
+    ))
+    new_users = [user for email, user in unique_users.items() if email not in existing]
+    # End the read transaction so the pooled connection is released while hashing
+    db.commit()
+    
+    created = 0
+    if new_users:
+        hashed_pws = hash_passwords_pooled([user.password for user in new_users])
+        # ON CONFLICT covers rows inserted concurrently since the check above
+        stmt = (
+            pg_insert(UserDB)
+            .on_conflict_do_nothing(index_elements=[func.lower(UserDB.email)])
+            .returning(UserDB.id)
+        )
+        result = db.execute(
+            stmt,
+            [{"email": user.email, "password": pw} for user, pw in zip(new_users, hashed_pws)],
+        )
+        created = len(result.all())
+        db.commit()
+    
+    return {"message": f"Registered {created} of {len(data.users)} users"}
+
+@router.get("/api/users", response_model=UserPage, tags=["API"])
+def get_all_users(
+    limit: int = Query(50, ge=1, le=500),
+    after_id: Optional[int] = None,
+    db: Session = Depends(get_db),
+):
     """
-    Get all users (passwords excluded from response)
+    Get users, paginated by id (passwords excluded from response)
     
     SECURITY FIX: Using response_model to exclude password field
+    PERFORMANCE: Keyset pagination keeps each request bounded; pass the
+    returned next_cursor as after_id to fetch the following page
     """
-    users = db.query(UserDB).all()
-    return users
+    users, next_cursor = get_users_page(db, limit, after_id)
+    return {"users": users, "next_cursor": next_cursor}
 
 @router.put("/api/user/change-password/{email}", response_model=MessageResponse, tags=["API"])
-def update_password(email: str, data: PasswordUpdate, db: Session = Depends(get_db)):
+@limiter.limit("5/minute")
+def update_password(
+    request: Request,
+    data: PasswordUpdate,
+    email: str = Path(..., max_length=MAX_EMAIL_LENGTH),
+    db: Session = Depends(get_db),
+):
     """
     Update user password with proper hashing
     
     SECURITY FIX: New password is now hashed
     BEST PRACTICE: More descriptive function name
     """
-    user = db.query(UserDB).filter(UserDB.email == email).first()
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
+    email = normalize_email(email)
     
-    # Hash the new password
-    user.password = hash_password(data.new_password)
+    # Hash the new password, then update in a single statement
+    hashed_pw = hash_password_pooled(data.new_password)
+    result = db.execute(
+        update(UserDB)
+        .where(func.lower(UserDB.email) == email)
+        .values(password=hashed_pw, verify_salt=secrets.token_bytes(16))
+    )
     db.commit()
+    if result.rowcount == 0:
+        raise HTTPException(status_code=404, detail="User not found")
+    with _verify_cache_lock:
+        _verify_cache.pop(email, None)
     
     return {"message": "Password updated successfully"}
 
 @router.delete("/api/user/{email}", response_model=MessageResponse, tags=["API"])
-def delete_user(email: str, db: Session = Depends(get_db)):
+def delete_user(email: str = Path(..., max_length=MAX_EMAIL_LENGTH), db: Session = Depends(get_db)):
     """
     Delete a user by email
     
     BUG FIX: Added response model for consistency
     """
-    user = db.query(UserDB).filter(UserDB.email == email).first()
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    db.delete(user)
+    email = normalize_email(email)
+    result = db.execute(delete(UserDB).where(func.lower(UserDB.email) == email))
     db.commit()
+    if result.rowcount == 0:
+        raise HTTPException(status_code=404, detail="User not found")
+    with _verify_cache_lock:
+        _verify_cache.pop(email, None)
     
     return {"message": "User deleted successfully"}
 
@@ -152,23 +346,71 @@ def delete_user(email: str, db: Session = Depends(get_db)):
 # ============================================================================
 
 class LoginSchema(BaseModel):
-    email: EmailStr
-    password: str
+    email: EmailStr = Field(..., max_length=MAX_EMAIL_LENGTH)
+    password: str = Field(..., min_length=1, max_length=72)  # bcrypt limit
+    
+    model_config = REQUEST_MODEL_CONFIG
+    
+    @field_validator("email", mode="before")
+    @classmethod
+    def check_email(cls, value):
+        return normalize_email(value)
 
 @router.post("/api/login", response_model=MessageResponse, tags=["API"])
-def login(credentials: LoginSchema, db: Session = Depends(get_db)):
+@limiter.limit("5/minute")
+def login(request: Request, credentials: LoginSchema, db: Session = Depends(get_db)):
     """
     Login endpoint - verifies email and password
     
     Note: In production, you'd want to return a JWT token here
     """
-    user = db.query(UserDB).filter(UserDB.email == credentials.email).first()
-    
-    if not user:
+    # Registration requires 8+ characters, so shorter passwords can never
+    # match; reject them without touching the database or bcrypt
+    if len(credentials.password) < 8:
         raise HTTPException(status_code=401, detail="Invalid email or password")
     
-    # Verify password
-    if not verify_password(credentials.password, user.password):
+    user = db.query(UserDB).filter(func.lower(UserDB.email) == credentials.email).first()
+    # Release the pooled connection before bcrypt; user stays loaded
+    # because sessions don't expire attributes on commit
+    db.commit()
+    
+    # Fast path: this password was verified recently for this user
+    cache_key = None
+    if user and user.verify_salt:
+        cache_key = _verify_cache_key(user.verify_salt, credentials.password)
+        with _verify_cache_lock:
+            cached = _verify_cache.get(credentials.email)
+        if cached is not None and hmac.compare_digest(cached, cache_key):
+            return {"message": "Login successful"}
+    
+    # Always run bcrypt (against a dummy hash for unknown emails) so timing
+    # doesn't leak whether the account exists
+    hashed_pw = user.password if user else _DUMMY_HASH
+    password_ok = verify_password_pooled(credentials.password, hashed_pw)
+    
+    if user is None or not password_ok:
         raise HTTPException(status_code=401, detail="Invalid email or password")
     
+    # Upgrade hashes made at a different cost to BCRYPT_ROUNDS, and give rows
+    # that predate verify_salt a salt so they can use the cache. Matching on
+    # the old hash avoids overwriting a concurrent password change.
+    changes = {}
+    if needs_rehash(user.password):
+        changes["password"] = hash_password_pooled(credentials.password)
+    if not user.verify_salt:
+        changes["verify_salt"] = secrets.token_bytes(16)
+    if changes:
+        result = db.execute(
+            update(UserDB)
+            .where(UserDB.id == user.id, UserDB.password == user.password)
+            .values(**changes)
+        )
+        db.commit()
+        if "verify_salt" in changes and result.rowcount == 1:
+            cache_key = _verify_cache_key(changes["verify_salt"], credentials.password)
+    
+    if cache_key is not None:
+        with _verify_cache_lock:
+            _verify_cache[credentials.email] = cache_key
+    
     return {"message": "Login successful"}